@@ -2,13 +2,18 @@ import streamlit as st
 import pandas as pd
 import os
 from datetime import datetime
-import uuid
 import chroma
+import maintenance
+
+# 嵌入模型只加载一次，在所有会话和重跑之间共享（多进程编码池也随之复用）
+@st.cache_resource
+def load_embedding_model():
+    return chroma.init_embedding_model()
 
 # 初始化Chroma数据库和嵌入模型
 try:
     collection = chroma.init_chroma_db()
-    model = chroma.init_embedding_model()
+    model = load_embedding_model()
 except Exception as e:
     st.error(f"❌ 系统初始化失败: {str(e)}")
     st.stop()
@@ -20,6 +25,12 @@ st.set_page_config(
     layout="wide"
 )
 
+# 启用只读副本时，启动时从数据库加载到内存
+try:
+    chroma.get_query_collection(collection)
+except Exception as e:
+    st.warning(f"⚠️ 只读副本加载失败: {str(e)}")
+
 # 初始化session state
 if "uploaded_files" not in st.session_state:
     st.session_state.uploaded_files = []
@@ -46,7 +57,7 @@ if selected_function == "上传知识库":
     # 文件上传
     uploaded_files = st.file_uploader(
         "选择要上传的文档:",
-        type=['txt', 'pdf', 'docx', 'md', 'xlsx'],
+        type=['txt', 'pdf', 'docx', 'md', 'xlsx', 'xls'],
         accept_multiple_files=True,
         help="支持上传多个文件"
     )
@@ -98,43 +109,8 @@ if selected_function == "上传知识库":
                         progress = int((i + 1) / len(uploaded_files) * 100)
                         progress_bar.progress(progress)
 
-                        # 1. 加载文档
-                        documents = chroma.load_document(file_path, file.type)
-                        if not documents:
-                            st.warning(f"⚠️ 无法加载文件: {file.name}")
-                            continue
-                        
-                        # 2. 分割文档
-                        splits = chroma.split_documents(documents)
-                        if not splits:
-                            st.warning(f"⚠️ 无法分割文件: {file.name}")
-                            continue
-                        
-                        # 3. 准备数据
-                        texts = [split.page_content for split in splits]
-                        metadatas = []
-                        ids = []
-                        
-                        for i, split in enumerate(splits):
-                            metadata = {
-                                "file_name": file.name,
-                                "file_type": file.type,
-                                "file_path": file_path,
-                                "chunk_index": i,
-                                "total_chunks": len(splits),
-                                "embedding_type": "knowledge_base"
-                            }
-                            metadatas.append(metadata)
-                            ids.append(f"kb_{file.name}_{i}_{uuid.uuid4().hex[:8]}")
-                        
-                        # 4. 生成嵌入向量
-                        embeddings = chroma.generate_embeddings(texts, model)
-                        if embeddings is None:
-                            st.error(f"❌ 生成嵌入向量失败: {file.name}")
-                            continue
-                        
-                        # 5. 存储到数据库
-                        success, message = chroma.store_documents_to_collection(texts, embeddings, metadatas, ids, collection)
+                        # 加载、分割、嵌入并存储到数据库
+                        success, message = chroma.index_file(file_path, file.name, file.type, collection, model)
                         if success:
                             st.success(f"✅ {file.name}: {message}")
                         else:
@@ -151,6 +127,13 @@ if selected_function == "上传知识库":
 elif selected_function == "知识库查询":
     st.header("🔍 知识库查询")
     
+    # 查询使用的集合（启用只读副本时为内存副本）
+    try:
+        query_collection = chroma.get_query_collection(collection)
+    except Exception as e:
+        st.warning(f"⚠️ 只读副本不可用，改为直接查询数据库: {e}")
+        query_collection = collection
+    
     # 查询输入
     query = st.text_area(
         "输入查询内容:",
@@ -160,14 +143,17 @@ elif selected_function == "知识库查询":
     )
     
     # 查询选项
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     with col1:
         max_results = st.number_input("最大结果数", 1, 20, 5)
     
     with col2:
+        context_window = st.number_input("上下文块数", 0, 10, 0, help="为每个结果补充前后相邻的文本块，合并为连续段落")
+    
+    with col3:
         # 获取所有文件名作为过滤选项
         try:
-            all_results = collection.get(include=['metadatas'])
+            all_results = query_collection.get(include=['metadatas'])
             file_names = set()
             for metadata in all_results['metadatas']:
                 if metadata and metadata.get('file_name'):
@@ -188,16 +174,26 @@ elif selected_function == "知识库查询":
         if query:
             with st.spinner("正在查询..."):
                 # 执行向量搜索
-                results = chroma.search_documents(query, collection, model, n_results=max_results, file_filter=file_filter)
+                results = chroma.search_documents(query, query_collection, model, n_results=max_results, file_filter=file_filter)
                 
                 if results:
                     filter_text = f" (在 {file_filter} 中)" if file_filter else ""
                     st.success(f"找到 {len(results)} 个相关结果{filter_text}")
                     
-                    # 显示结果
-                    for i, result in enumerate(results, 1):
-                        with st.expander(f"结果 {i}: {result['文档']} (相似度: {result['相似度']:.2f}) - 块 {result['块索引']+1}/{result['总块数']}"):
-                            st.write(result["内容"])
+                    if context_window > 0:
+                        # 补充相邻块，合并为连续段落
+                        passages, lookup_stats = chroma.expand_search_context(results, query_collection, context_window)
+                        st.caption(f"上下文扩展: {lookup_stats['查询次数']} 次批量查询，读取 {lookup_stats['读取块数']} 个块，耗时 {lookup_stats['耗时']*1000:.1f} ms")
+                        
+                        for i, passage in enumerate(passages, 1):
+                            start, end = passage["块范围"]
+                            with st.expander(f"段落 {i}: {passage['文档']} (相似度: {passage['相似度']:.2f}) - 块 {start+1}-{end+1}/{passage['总块数']}"):
+                                st.write(passage["内容"])
+                    else:
+                        # 显示结果
+                        for i, result in enumerate(results, 1):
+                            with st.expander(f"结果 {i}: {result['文档']} (相似度: {result['相似度']:.2f}) - 块 {result['块索引']+1}/{result['总块数']}"):
+                                st.write(result["内容"])
                 else:
                     filter_text = f"在 {file_filter} 中" if file_filter else ""
                     st.warning(f"未找到相关结果{filter_text}，请尝试调整查询条件")
@@ -354,10 +350,86 @@ with st.sidebar:
         st.metric("已有文件", 0)
         st.metric("总大小", "0 MB")
     
+    # 文档解析统计
+    loader_stats = chroma.get_loader_statistics()
+    if loader_stats:
+        with st.expander("⏱️ 解析性能"):
+            stats_rows = []
+            for loader_name, stats in loader_stats.items():
+                stats_rows.append({
+                    "加载器": loader_name,
+                    "调用": stats["calls"],
+                    "成功": stats["successes"],
+                    "失败": stats["failures"],
+                    "超时": stats["timeouts"],
+                    "成功耗时(s)": round(stats["ok_seconds"], 2),
+                    "失败/超时耗时(s)": round(stats["failed_seconds"], 2),
+                    "吞吐(MB/s)": round(stats["mb_per_second"], 2)
+                })
+            st.dataframe(pd.DataFrame(stats_rows), width='stretch', hide_index=True)
+    
+    # 只读副本状态
+    try:
+        replica_status = chroma.get_replica_status()
+    except Exception as e:
+        replica_status = None
+        st.warning(f"⚠️ 获取只读副本状态失败: {str(e)}")
+    if replica_status:
+        st.subheader("⚡ 只读副本")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("副本延迟", f"{replica_status['lag_seconds']:.1f} 秒", help=f"待同步变更 {replica_status['pending_changes']} 条，距上次同步 {replica_status['since_refresh_seconds']:.1f} 秒，跳过损坏日志 {replica_status['malformed_lines']} 行")
+        with col2:
+            st.metric("副本内存", f"{replica_status['memory_bytes']/1024/1024:.2f} MB", help=f"共 {replica_status['records']} 条记录（估算值）")
+    
     # 保存目录信息
     st.subheader("📂 保存位置")
     st.text(os.path.abspath(save_dir))
     
+    # 存储整理：先检查（不修改），确认后再修复
+    st.subheader("🧹 存储整理")
+    if st.button("🔍 检查存储", help="对比知识库文件与向量数据库，只检查不修改"):
+        try:
+            st.session_state.maintenance_report = maintenance.run_maintenance(collection, save_dir, dry_run=True)
+        except Exception as e:
+            st.session_state.maintenance_report = None
+            st.error(f"❌ 检查存储失败: {str(e)}")
+    
+    maintenance_report = st.session_state.get("maintenance_report")
+    if maintenance_report:
+        st.write("**检查结果（尚未修改）:**")
+        for line in maintenance.format_report(maintenance_report):
+            st.write(f"• {line}")
+        
+        reindex = st.checkbox("为未入库和块不完整的文件重新生成向量", value=False)
+        compact = st.checkbox("修复后压缩数据库", value=False, help="在独立进程中执行 VACUUM，需要在没有上传/删除进行时运行，否则会因数据库被占用而失败")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            confirm_repair = st.button("✅ 确认修复", type="primary", help="修复前会重新检查一次，只处理当时仍存在的问题")
+        with col2:
+            cancel_repair = st.button("取消")
+        
+        if confirm_repair:
+            with st.spinner("正在整理存储..."):
+                try:
+                    report = maintenance.run_maintenance(
+                        collection,
+                        save_dir,
+                        model=model if reindex else None,
+                        compact=compact,
+                        compact_out_of_process=True
+                    )
+                    st.success(f"✅ 整理完成，回收 {report['reclaimed_bytes']/1024/1024:.2f} MB，耗时 {report['total_seconds']:.2f} 秒")
+                    for line in maintenance.format_report(report):
+                        st.write(f"• {line}")
+                except Exception as e:
+                    st.error(f"❌ 整理存储失败: {str(e)}")
+            st.session_state.maintenance_report = None
+        elif cancel_repair:
+            st.session_state.maintenance_report = None
+            st.rerun()
+    
     # 清空数据按钮
     if st.button("🗑️ 清空所有数据"):
         # 1. 清空向量数据库
@@ -366,7 +438,7 @@ with st.sidebar:
             all_results = collection.get()
             if all_results['ids']:
                 # 删除所有向量记录
-                collection.delete(ids=all_results['ids'])
+                chroma.delete_ids_in_batches(all_results['ids'], collection)
                 st.success(f"✅ 已清空向量数据库 ({len(all_results['ids'])} 条记录)")
             else:
                 st.info("ℹ️ 向量数据库已为空")
@@ -6,19 +6,24 @@ from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 # 从LangChain库中导入RecursiveCharacterTextSplitter(用于将文本分割为小块)
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-# 从LangChain库中导入TextLoader, PyPDFLoader, Docx2txtLoader(用于加载文本文件)
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, Docx2txtLoader
-# 尝试引入 Excel 加载器（保持简单，仅支持该加载器）
-try:
-    from langchain_community.document_loaders import UnstructuredExcelLoader
-except Exception:
-    UnstructuredExcelLoader = None
-# 导入pandas用于Excel文件处理
-import pandas as pd
+# 导入文档加载器注册表(按文件类型选择解析器)
+import loaders
+# 导入内存只读副本(查询与写入分离)
+import replica
+# 导入atexit库(用于退出时关闭编码进程池)
+import atexit
+# 导入numpy用于向量数组处理
+import numpy as np
 # 导入os库(用于操作文件和目录)
 import os
 # 导入uuid库(用于生成唯一标识符)
 import uuid
+# 导入threading库(用于保护编码池)
+import threading
+# 导入time库(用于计时)
+import time
+# 导入weakref库(用于记录模型名称而不延长模型生命周期)
+import weakref
 # 导入datetime库(用于生成时间戳)
 from datetime import datetime
 
@@ -28,19 +33,24 @@ from dotenv import load_dotenv
 
 ## 数据库初始化
 
+# 数据库存储路径
+CHROMA_DB_PATH = "./chroma_db"
+# 知识库集合名称
+COLLECTION_NAME = "knowledge_base"
+
 ### 1. 创建 Chroma 客户端
 
 def init_chroma_db():
     """初始化 Chroma 数据库"""
     # 创建持久化本地向量数据库
     chroma_client = chromadb.PersistentClient(
-        path="./chroma_db",  # 数据库存储路径
+        path=CHROMA_DB_PATH,  # 数据库存储路径
         settings=Settings(anonymized_telemetry=False)
     )
     
     # 获取或创建集合
     collection = chroma_client.get_or_create_collection(
-        name="knowledge_base",
+        name=COLLECTION_NAME,
         metadata={"description": "知识库文档集合"}
     )
     
@@ -63,6 +73,7 @@ def init_embedding_model():
     try:
         # 初始化嵌入模型，明确指定使用CPU设备
         model = SentenceTransformer(model_name, device='cpu')
+        _MODEL_NAMES[model] = model_name
         return model  # 返回已初始化的嵌入模型，供后续生成向量使用
     except Exception as e:
         import streamlit as st
@@ -70,123 +81,137 @@ def init_embedding_model():
         # 如果指定模型失败，尝试使用默认模型
         try:
             model = SentenceTransformer("all-MiniLM-L6-v2", device='cpu')
+            _MODEL_NAMES[model] = "all-MiniLM-L6-v2"
             st.write("使用默认模型 all-MiniLM-L6-v2")
             return model
         except Exception as e2:
             st.write(f"默认模型也初始化失败: {e2}")
             raise e2
 
-## 文件处理功能
+### 3. 内存只读副本
 
-### 1. 文件加载器
+# 只读副本（模块级，Streamlit 重跑脚本时复用）
+_READ_REPLICA = None
+# 只读副本配置（进程内只读取一次，修改 .env 后需重启应用）
+_REPLICA_SETTINGS = None
+
+def get_replica_settings():
+    """读取只读副本配置（首次调用时读取，之后复用）
+    
+    环境变量（可写在 .env 中）:
+        read_replica: 为 1/true 时查询走内存副本，写入路径同时记录变更日志
+        replica_max_staleness: 允许的最大延迟（秒），默认 5
+    
+    Returns:
+        tuple: (enabled: bool, max_staleness: float)
+    """
+    global _REPLICA_SETTINGS
+    if _REPLICA_SETTINGS is None:
+        try:
+            load_dotenv("./.env")
+        except:
+            pass
+        enabled = os.getenv("read_replica", "0").strip().lower() in ("1", "true", "yes")
+        try:
+            max_staleness = float(os.getenv("replica_max_staleness", "5"))
+        except ValueError:
+            max_staleness = 5.0
+        _REPLICA_SETTINGS = (enabled, max_staleness)
+    return _REPLICA_SETTINGS
 
-def load_document(file_path, file_type):
-    """根据文件类型加载文档"""
+def record_change(op, ids):
+    """写入路径调用：启用只读副本时追加变更日志（op 为 'upsert' 或 'delete'）
+    
+    只在写入成功后调用。日志写入失败不影响已完成的写入：改为让只读副本重新全量加载，
+    并返回提示信息。
+    
+    Returns:
+        str: 日志写入失败时的提示，否则为 None
+    """
+    enabled, _ = get_replica_settings()
+    if not enabled:
+        return None
     try:
-        if file_type in ['txt', 'md', 'text/plain']:
-            loader = TextLoader(file_path, encoding='utf-8')
-        elif file_type in ['pdf','PDF','application/pdf']:
-            loader = PyPDFLoader(file_path)
-        elif file_type == 'docx':
-            loader = Docx2txtLoader(file_path)
-        elif file_type in ['xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet']:
-            # 首先尝试使用UnstructuredExcelLoader
-            if UnstructuredExcelLoader is not None:
-                try:
-                    loader = UnstructuredExcelLoader(file_path)
-                    documents = loader.load()
-                    return documents
-                except Exception as e:
-                    import streamlit as st
-                    st.write(f"UnstructuredExcelLoader加载失败: {e}，尝试使用pandas")
-            
-            # 备用方案：使用pandas读取Excel文件
-            try:
-                import streamlit as st
-                st.write(f"尝试使用pandas加载Excel文件: {file_path}")
-                
-                # 尝试不同的引擎
-                engines = ['openpyxl', 'xlrd']
-                excel_file = None
-                
-                for engine in engines:
-                    try:
-                        st.write(f"尝试使用引擎: {engine}")
-                        excel_file = pd.ExcelFile(file_path, engine=engine)
-                        st.write(f"成功使用 {engine} 引擎")
-                        break
-                    except Exception as engine_error:
-                        st.write(f"引擎 {engine} 失败: {engine_error}")
-                        continue
-                
-                if excel_file is None:
-                    st.error("所有Excel引擎都失败了")
-                    return None
-                
-                documents = []
-                st.write(f"发现 {len(excel_file.sheet_names)} 个工作表: {excel_file.sheet_names}")
-                
-                for sheet_name in excel_file.sheet_names:
-                    try:
-                        df = pd.read_excel(file_path, sheet_name=sheet_name, engine=excel_file.engine)
-                        st.write(f"工作表 '{sheet_name}' 有 {len(df)} 行数据")
-                        
-                        # 将DataFrame转换为文本
-                        text_content = f"工作表: {sheet_name}\n\n"
-                        
-                        # 添加列名
-                        if not df.empty:
-                            text_content += "列名: " + ", ".join(df.columns.astype(str)) + "\n\n"
-                            
-                            # 添加数据行
-                            for index, row in df.iterrows():
-                                row_text = " | ".join([f"{col}: {val}" for col, val in row.items() if pd.notna(val)])
-                                if row_text.strip():
-                                    text_content += f"行{index + 1}: {row_text}\n"
-                        
-                        # 创建文档对象
-                        from langchain_core.documents import Document
-                        doc = Document(
-                            page_content=text_content,
-                            metadata={"source": file_path, "sheet_name": sheet_name}
-                        )
-                        documents.append(doc)
-                        
-                    except Exception as sheet_error:
-                        st.warning(f"工作表 '{sheet_name}' 加载失败: {sheet_error}")
-                        continue
-                
-                st.write(f"成功加载Excel文件，共生成 {len(documents)} 个文档")
-                return documents
-                
-            except Exception as e:
-                import streamlit as st
-                st.error(f"pandas加载Excel文件失败: {e}")
-                st.write(f"文件路径: {file_path}")
-                st.write(f"文件类型: {file_type}")
-                st.write(f"错误类型: {type(e).__name__}")
-                return None
-        else:
-            return None
-        
-        # 对于非Excel文件，加载文档
-        documents = loader.load()
-        return documents
+        replica.append_change(CHROMA_DB_PATH, op, ids)
+        return None
     except Exception as e:
-        import streamlit as st
-        st.write(f"加载文件失败: {e}")
-        st.write(f"文件路径: {file_path}")
-        st.write(f"文件类型: {file_type}")
+        # 替换日志文件，所有读取它的副本（包括其他进程）都会重新全量加载
+        if _READ_REPLICA is not None:
+            _READ_REPLICA.request_reload()
+        try:
+            replica.truncate_change_log(CHROMA_DB_PATH)
+        except Exception:
+            pass
+        return f"变更日志写入失败: {str(e)}，只读副本将重新全量加载"
+
+def get_query_collection(collection):
+    """返回用于查询的集合
+    
+    启用只读副本时返回内存副本（首次调用时从持久化集合加载，
+    之后超过允许延迟会先增量同步），否则直接返回持久化集合。
+    """
+    global _READ_REPLICA
+    enabled, max_staleness = get_replica_settings()
+    if not enabled:
+        return collection
+    if _READ_REPLICA is None:
+        _READ_REPLICA = replica.ReadReplica(collection, CHROMA_DB_PATH, max_staleness=max_staleness)
+    _READ_REPLICA.max_staleness = max_staleness
+    return _READ_REPLICA.get_collection()
+
+def get_replica_status():
+    """获取只读副本状态，未启用或尚未加载时返回 None，见 replica.ReadReplica.status"""
+    if _READ_REPLICA is None:
         return None
+    return _READ_REPLICA.status()
+
+## 文件处理功能
+
+### 1. 文件加载器
+
+def load_document(file_path, file_type=None, isolate=True):
+    """根据文件类型加载文档
+    
+    文件类型由扩展名和文件头魔数识别，file_type（如 file.type 的 MIME 类型）
+    只作为提示。具体的加载器及兜底顺序见 loaders.LOADER_REGISTRY。
+    
+    Args:
+        file_path: 文件路径
+        file_type: 类型提示（扩展名或 MIME 类型，可选）
+        isolate: 是否在子进程中运行加载器（启用超时和崩溃隔离）
+    
+    Returns:
+        list: 文档列表，加载失败时返回 None
+    """
+    documents, loader_name, errors = loaders.load_with_registry(file_path, file_type, isolate=isolate)
+    if documents:
+        return documents
+    
+    import streamlit as st
+    st.write(f"加载文件失败: {file_path}")
+    st.write(f"文件类型: {file_type}")
+    for error in errors:
+        st.write(f"- {error}")
+    return None
+
+def get_loader_statistics():
+    """获取每个加载器的解析吞吐统计，见 loaders.get_loader_statistics"""
+    return loaders.get_loader_statistics()
 
 ### 2. 文本分割器
 
+# 每个块的大小
+CHUNK_SIZE = 200
+# 块之间的重叠
+CHUNK_OVERLAP = 100
+
 def split_documents(documents):
     """将文档分割成小块"""
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=200,      # 每个块的大小
-        chunk_overlap=100,   # 块之间的重叠
+        chunk_size=CHUNK_SIZE,        # 每个块的大小
+        chunk_overlap=CHUNK_OVERLAP,  # 块之间的重叠
         length_function=len,
+        add_start_index=True,         # 在元数据中记录块在原文中的起始位置（start_index）
     )
     
     splits = text_splitter.split_documents(documents)
@@ -194,19 +219,116 @@ def split_documents(documents):
 
 ### 3. 文档嵌入和存储
 
-def generate_embeddings(texts, model):
+# 多进程编码池（模块级，Streamlit 重跑脚本时复用）；同一时间只保留一个，
+# 模型或进程数变化时先停止旧池再创建新池
+_EMBEDDING_POOL = {"key": None, "pool": None}
+_EMBEDDING_POOL_LOCK = threading.Lock()
+# 模型对象 -> 模型名称（弱引用，不延长模型生命周期）
+_MODEL_NAMES = weakref.WeakKeyDictionary()
+
+def get_embedding_settings():
+    """读取嵌入编码配置
+    
+    环境变量（可写在 .env 中）:
+        embedding_workers: 编码进程数，1 为单进程，0 或 auto 为使用全部 CPU 核
+        embedding_batch_size: 每批编码的文本数
+    
+    Returns:
+        tuple: (num_workers: int, batch_size: int)
+    """
+    workers = os.getenv("embedding_workers", "1").strip().lower()
+    if workers in ("0", "auto"):
+        num_workers = os.cpu_count() or 1
+    else:
+        num_workers = max(1, int(workers))
+    batch_size = max(1, int(os.getenv("embedding_batch_size", "32")))
+    return num_workers, batch_size
+
+def stop_embedding_pool():
+    """停止当前的多进程编码池（进程退出时自动调用）"""
+    with _EMBEDDING_POOL_LOCK:
+        _stop_embedding_pool()
+
+def _stop_embedding_pool():
+    """停止当前编码池（调用方需持有 _EMBEDDING_POOL_LOCK）"""
+    if _EMBEDDING_POOL["pool"] is not None:
+        SentenceTransformer.stop_multi_process_pool(_EMBEDDING_POOL["pool"])
+    _EMBEDDING_POOL["key"] = None
+    _EMBEDDING_POOL["pool"] = None
+
+atexit.register(stop_embedding_pool)
+
+def get_embedding_pool(model, num_workers):
+    """获取（或创建）多进程编码池，每个 CPU 进程加载一份模型
+    
+    编码池按 (模型名称, 进程数) 复用；两者变化时停止旧池并创建新池，
+    不会随 Streamlit 重跑累积进程。每个进程的 torch 线程数限制为
+    CPU核数/进程数，避免进程间线程争抢。
+    """
+    key = (_MODEL_NAMES.get(model, id(model)), num_workers)
+    with _EMBEDDING_POOL_LOCK:
+        if _EMBEDDING_POOL["key"] == key:
+            return _EMBEDDING_POOL["pool"]
+        _stop_embedding_pool()
+        
+        threads = str(max(1, (os.cpu_count() or 1) // num_workers))
+        previous = os.environ.get("OMP_NUM_THREADS")
+        os.environ["OMP_NUM_THREADS"] = threads
+        try:
+            pool = model.start_multi_process_pool(target_devices=['cpu'] * num_workers)
+        finally:
+            if previous is None:
+                os.environ.pop("OMP_NUM_THREADS", None)
+            else:
+                os.environ["OMP_NUM_THREADS"] = previous
+        _EMBEDDING_POOL["key"] = key
+        _EMBEDDING_POOL["pool"] = pool
+        return pool
+
+def generate_embeddings(texts, model, batch_size=None, num_workers=None):
     """生成文本的嵌入向量
     
+    文本先按长度排序再分批，同一批内长度相近，减少填充浪费；
+    num_workers > 1 时使用多进程编码池，结果按原始顺序返回。
+    
     Args:
         texts: 文本列表
         model: 嵌入模型
+        batch_size: 每批文本数（默认读取 embedding_batch_size）
+        num_workers: 编码进程数（默认读取 embedding_workers）
     
     Returns:
         list: 嵌入向量列表
     """
+    if not texts:
+        return []
+    
     try:
-        embeddings = model.encode(texts).tolist()
-        return embeddings
+        default_workers, default_batch_size = get_embedding_settings()
+        batch_size = batch_size or default_batch_size
+        num_workers = num_workers or default_workers
+        
+        # 按长度排序，分批时长短文本不混在一起
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        sorted_texts = [texts[i] for i in order]
+        
+        # 文本太少时多进程的分发开销大于收益
+        if num_workers > 1 and len(texts) >= batch_size * num_workers:
+            pool = get_embedding_pool(model, num_workers)
+            sorted_embeddings = model.encode_multi_process(
+                sorted_texts,
+                pool,
+                batch_size=batch_size,
+                # 按排序后的顺序切块，每个进程拿到的都是长度相近的文本
+                chunk_size=batch_size * 4
+            )
+        else:
+            sorted_embeddings = model.encode(sorted_texts, batch_size=batch_size)
+        
+        # 恢复原始顺序
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+        return embeddings.tolist()
     except Exception as e:
         import streamlit as st
         st.write(f"生成嵌入向量失败: {e}")
@@ -232,9 +354,106 @@ def store_documents_to_collection(texts, embeddings, metadatas, ids, collection)
             metadatas=metadatas,
             ids=ids
         )
-        return True, f"成功存储 {len(texts)} 个文档"
     except Exception as e:
         return False, f"存储失败: {str(e)}"
+    
+    message = f"成功存储 {len(texts)} 个文档"
+    warning = record_change("upsert", ids)
+    if warning:
+        message += f"（{warning}）"
+    return True, message
+
+def delete_ids_in_batches(ids, collection, batch_size=500):
+    """按批次删除向量记录
+    
+    Args:
+        ids: 要删除的记录ID列表
+        collection: Chroma集合对象
+        batch_size: 每批删除的记录数
+    
+    Returns:
+        int: 删除的记录数
+    
+    变更日志写入失败时只读副本会重新全量加载（见 record_change），不影响后续批次。
+    """
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        batch_ids = ids[start:start + batch_size]
+        collection.delete(ids=batch_ids)
+        record_change("delete", batch_ids)
+    return len(ids)
+
+def index_file(file_path, file_name, file_type, collection, model):
+    """加载、分割、嵌入并存储单个文件
+    
+    同名文件已有的向量记录会在新记录写入成功后删除，重复上传不会产生重复块。
+    
+    Args:
+        file_path: 文件路径
+        file_name: 文件名（写入元数据，用于过滤和删除）
+        file_type: 类型提示（扩展名或 MIME 类型，可选）
+        collection: Chroma集合对象
+        model: 嵌入模型
+    
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    # 1. 加载文档
+    documents = load_document(file_path, file_type)
+    if not documents:
+        return False, "无法加载文件"
+    
+    # 2. 分割文档
+    splits = split_documents(documents)
+    if not splits:
+        return False, "无法分割文件"
+    
+    # 3. 准备数据
+    texts = [split.page_content for split in splits]
+    upload_id = uuid.uuid4().hex
+    upload_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    metadatas = []
+    ids = []
+    
+    for i, split in enumerate(splits):
+        metadata = {
+            "file_name": file_name,
+            "file_type": file_type or "未知",
+            "file_path": file_path,
+            "chunk_index": i,
+            "total_chunks": len(splits),
+            "embedding_type": "knowledge_base",
+            "upload_id": upload_id,
+            "upload_time": upload_time
+        }
+        # 块在所属原文（如 PDF 的一页）中的起始位置，用于拼接上下文时精确去掉重叠
+        if split.metadata.get("start_index") is not None:
+            metadata["start_index"] = split.metadata["start_index"]
+        metadatas.append(metadata)
+        ids.append(f"kb_{file_name}_{i}_{uuid.uuid4().hex[:8]}")
+    
+    # 4. 生成嵌入向量
+    embeddings = generate_embeddings(texts, model)
+    if embeddings is None:
+        return False, "生成嵌入向量失败"
+    
+    # 5. 记录旧版本的ID，新记录写入成功后再删除；读取不完整时不写入，避免留下重复块
+    try:
+        old_ids = [record_id
+                   for page in get_documents_by_filename(file_name, collection, include=[])
+                   for record_id in page["ids"]]
+    except Exception as e:
+        return False, f"读取旧记录失败: {str(e)}"
+    
+    # 6. 存储到数据库
+    success, message = store_documents_to_collection(texts, embeddings, metadatas, ids, collection)
+    if success and old_ids:
+        try:
+            delete_ids_in_batches(old_ids, collection)
+            message += f"，替换了 {len(old_ids)} 条旧记录"
+        except Exception as e:
+            message += f"，但旧记录删除失败: {str(e)}"
+    return success, message
 
 def delete_documents_by_filename(file_name, collection):
     """根据文件名删除向量数据库中的相关记录
@@ -257,46 +476,75 @@ def delete_documents_by_filename(file_name, collection):
                 ids_to_delete.append(all_results['ids'][i])
         
         # 3. 删除匹配的记录
-        if ids_to_delete:
-            collection.delete(ids=ids_to_delete)
-            return True, len(ids_to_delete), f"成功删除 {len(ids_to_delete)} 条向量记录"
-        else:
+        if not ids_to_delete:
             return True, 0, f"未找到文件 {file_name} 的向量记录"
+        collection.delete(ids=ids_to_delete)
             
     except Exception as e:
         return False, 0, f"删除向量记录失败: {str(e)}"
+    
+    message = f"成功删除 {len(ids_to_delete)} 条向量记录"
+    warning = record_change("delete", ids_to_delete)
+    if warning:
+        message += f"（{warning}）"
+    return True, len(ids_to_delete), message
 
-def get_documents_by_filename(file_name, collection):
-    """根据文件名获取所有相关的向量记录
+def get_documents_by_filename(file_name, collection, include=None, page_size=500):
+    """根据文件名分页获取相关的向量记录（生成器）
+    
+    过滤条件直接下推到 Chroma（where），每次只读取一页，
+    内存占用与单个文件的记录数相关，而不是整个知识库。
     
     Args:
         file_name: 文件名
         collection: Chroma集合对象
+        include: 需要返回的字段，可选 'documents'、'metadatas'、'embeddings'
+                 （默认 ['documents', 'metadatas']，不读取向量）
+        page_size: 每页记录数
     
-    Returns:
-        list: 该文件的所有向量记录
+    Yields:
+        dict: 一页记录，包含 "ids" 以及 include 中指定的字段；
+              "embeddings" 为形状 (n, dim) 的 NumPy 数组
+    
+    Raises:
+        Exception: Chroma 查询失败时直接抛出，调用方据此区分部分结果与完整结果
     """
-    try:
-        # 查询所有记录
-        all_results = collection.get(include=['documents', 'metadatas', 'embeddings'])
+    if include is None:
+        include = ['documents', 'metadatas']
+    include = list(include)
+    if page_size < 1:
+        raise ValueError("page_size 必须大于 0")
+    
+    offset = 0
+    while True:
+        results = collection.get(
+            where={"file_name": file_name},
+            include=include,
+            limit=page_size,
+            offset=offset
+        )
         
-        # 筛选匹配文件名的记录
-        file_records = []
-        for i, metadata in enumerate(all_results['metadatas']):
-            if metadata and metadata.get('file_name') == file_name:
-                file_records.append({
-                    "id": all_results['ids'][i],
-                    "document": all_results['documents'][i],
-                    "metadata": metadata,
-                    "embedding": all_results['embeddings'][i] if all_results['embeddings'] else None
-                })
+        ids = results['ids']
+        if not ids:
+            return
         
-        return file_records
+        page = {"ids": ids}
+        if 'documents' in include:
+            page["documents"] = results['documents']
+        if 'metadatas' in include:
+            page["metadatas"] = results['metadatas']
+        if 'embeddings' in include:
+            embeddings = results.get('embeddings')
+            if embeddings is None or len(embeddings) == 0:
+                page["embeddings"] = np.empty((0, 0), dtype=np.float32)
+            else:
+                page["embeddings"] = np.asarray(embeddings, dtype=np.float32)
+        yield page
         
-    except Exception as e:
-        import streamlit as st
-        st.write(f"获取文件记录失败: {e}")
-        return []
+        # 最后一页不足 page_size 时结束
+        if len(ids) < page_size:
+            return
+        offset += len(ids)
 
 def get_file_statistics(collection):
     """获取所有文件的统计信息
@@ -380,7 +628,9 @@ def search_documents(query, collection, model, n_results=5, file_filter=None):
                     "内容": doc,
                     "文件类型": metadata['file_type'],
                     "块索引": metadata['chunk_index'],
-                    "总块数": metadata.get('total_chunks', '未知')
+                    "总块数": metadata.get('total_chunks', '未知'),
+                    "上传批次": _upload_version(metadata),
+                    "起始位置": metadata.get('start_index')
                 })
         
         return search_results
@@ -389,3 +639,167 @@ def search_documents(query, collection, model, n_results=5, file_filter=None):
         import streamlit as st
         st.write(f"搜索失败: {e}")
         return []
+
+def _upload_version(metadata):
+    """记录所属的上传批次；旧数据没有 upload_id，用 total_chunks 近似区分"""
+    return metadata.get('upload_id') or f"legacy:{metadata.get('total_chunks')}"
+
+def _merge_chunk_texts(texts, min_overlap=CHUNK_OVERLAP // 2):
+    """拼接相邻文本块，去掉块之间重叠（chunk_overlap）的重复部分（用于没有 start_index 的旧记录）
+    
+    只有重叠长度不少于 min_overlap 时才视为分割器产生的重叠并去掉，
+    否则用换行连接，避免偶然相同的首尾字符被误删。
+    """
+    merged = ""
+    for text in texts:
+        if not merged:
+            merged = text
+            continue
+        # 在分割器重叠长度范围内找前一段结尾与当前块开头的最长重叠
+        overlap = 0
+        for size in range(min(len(merged), len(text), CHUNK_OVERLAP), min_overlap - 1, -1):
+            if merged.endswith(text[:size]):
+                overlap = size
+                break
+        if overlap:
+            merged += text[overlap:]
+        else:
+            merged += "\n" + text
+    return merged
+
+def _merge_chunks(chunks):
+    """按原文中的起始位置拼接相邻文本块
+    
+    Args:
+        chunks: [(文本, start_index)]，按块索引排序
+    
+    所有块都有 start_index 时按偏移量精确去掉重叠部分；起始位置不增加说明进入了
+    下一个原文（如 PDF 的下一页），用换行连接。任一块缺少 start_index 时退回 _merge_chunk_texts。
+    """
+    if any(start is None for _, start in chunks):
+        return _merge_chunk_texts([text for text, _ in chunks])
+    merged = ""
+    previous_start = previous_end = None
+    for text, start in chunks:
+        if previous_start is None:
+            merged = text
+        elif start > previous_start:
+            # 与前一块重叠的部分只保留一次；有间隔（被去掉的分隔空白）时用换行连接
+            if start > previous_end:
+                merged += "\n" + text
+            else:
+                merged += text[previous_end - start:]
+        else:
+            merged += "\n" + text
+        previous_start, previous_end = start, start + len(text)
+    return merged
+
+def expand_search_context(search_results, collection, context_window=1):
+    """为搜索结果补充前后相邻的文本块，合并为连续段落
+    
+    所有命中块的前后 context_window 个块通过一次批量 get 查询取回；
+    同一文件同一上传批次中重叠或相邻的窗口会被合并并去重，
+    文件被重复上传时只使用与命中块同一批次的相邻块。
+    
+    Args:
+        search_results: search_documents 的返回结果
+        collection: Chroma集合对象
+        context_window: 前后各扩展的块数
+    
+    Returns:
+        tuple: (passages: list, lookup_stats: dict)
+            passages 按最高相似度排序，lookup_stats 记录额外查询的耗时和读取块数
+    """
+    lookup_stats = {"查询次数": 0, "读取块数": 0, "耗时": 0.0}
+    if not search_results or context_window < 1:
+        passages = []
+        for result in search_results or []:
+            passage = dict(result)
+            passage["块范围"] = (result["块索引"], result["块索引"])
+            passage["命中块"] = [result["块索引"]]
+            passages.append(passage)
+        return passages, lookup_stats
+    
+    # 1. 按（文件, 上传批次）计算需要的块区间，并合并重叠/相邻的区间
+    hits_by_file = {}
+    for result in search_results:
+        hits_by_file.setdefault((result["文档"], result.get("上传批次")), []).append(result)
+    
+    ranges_by_file = {}
+    for file_key, hits in hits_by_file.items():
+        intervals = []
+        for hit in hits:
+            start = max(0, hit["块索引"] - context_window)
+            end = hit["块索引"] + context_window
+            if isinstance(hit["总块数"], int):
+                end = min(end, hit["总块数"] - 1)
+            intervals.append([start, end])
+        intervals.sort()
+        merged = [intervals[0]]
+        for start, end in intervals[1:]:
+            if start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        ranges_by_file[file_key] = merged
+    
+    # 2. 一次批量查询取回所有需要的块（每个文件一个条件）
+    indexes_by_name = {}
+    for (file_name, _), ranges in ranges_by_file.items():
+        indexes = indexes_by_name.setdefault(file_name, set())
+        indexes.update(i for start, end in ranges for i in range(start, end + 1))
+    clauses = []
+    for file_name, indexes in indexes_by_name.items():
+        clauses.append({"$and": [
+            {"file_name": file_name},
+            {"chunk_index": {"$in": sorted(indexes)}}
+        ]})
+    where_condition = clauses[0] if len(clauses) == 1 else {"$or": clauses}
+    
+    start_time = time.perf_counter()
+    try:
+        neighbors = collection.get(where=where_condition, include=['documents', 'metadatas'])
+    except Exception as e:
+        import streamlit as st
+        st.write(f"获取上下文失败: {e}")
+        neighbors = {"ids": [], "documents": [], "metadatas": []}
+    lookup_stats["查询次数"] = 1
+    lookup_stats["耗时"] = time.perf_counter() - start_time
+    lookup_stats["读取块数"] = len(neighbors['ids'])
+    
+    # 按（文件, 上传批次, 块索引）索引，重复上传的不同版本互不混用
+    chunks_by_key = {}
+    for doc, metadata in zip(neighbors['documents'], neighbors['metadatas']):
+        if metadata:
+            key = (metadata.get('file_name'), _upload_version(metadata), metadata.get('chunk_index'))
+            chunks_by_key.setdefault(key, (doc, metadata.get('start_index')))
+    
+    # 3. 按区间拼接成连续段落
+    passages = []
+    for (file_name, version), ranges in ranges_by_file.items():
+        hits = hits_by_file[(file_name, version)]
+        for start, end in ranges:
+            range_hits = [hit for hit in hits if start <= hit["块索引"] <= end]
+            best_hit = max(range_hits, key=lambda hit: hit["相似度"])
+            chunks = []
+            for index in range(start, end + 1):
+                chunk = chunks_by_key.get((file_name, version, index))
+                if chunk is None:
+                    # 邻近块缺失时，至少保留命中块本身
+                    chunk = next(((hit["内容"], hit.get("起始位置")) for hit in range_hits
+                                  if hit["块索引"] == index), None)
+                if chunk is not None:
+                    chunks.append(chunk)
+            passages.append({
+                "文档": file_name,
+                "相似度": best_hit["相似度"],
+                "内容": _merge_chunks(chunks),
+                "文件类型": best_hit["文件类型"],
+                "块索引": start,
+                "总块数": best_hit["总块数"],
+                "块范围": (start, end),
+                "命中块": sorted(hit["块索引"] for hit in range_hits)
+            })
+    
+    passages.sort(key=lambda passage: passage["相似度"], reverse=True)
+    return passages, lookup_stats
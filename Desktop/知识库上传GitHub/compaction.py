@@ -0,0 +1,87 @@
+# 数据库压缩
+# 压缩 Chroma 底层的 SQLite 文件（VACUUM 并截断 WAL）。
+# 本模块只依赖标准库，独立进程中执行压缩时不会加载 Chroma 和嵌入模型。
+#
+# 命令行用法:
+#     python compaction.py                       # 压缩默认数据库
+#     python compaction.py --db-path ./chroma_db
+#
+# 压缩（VACUUM）需要数据库的独占锁，请在没有上传/删除进行时运行。
+
+# 导入argparse库(用于解析命令行参数)
+import argparse
+# 导入os库(用于操作文件路径)
+import os
+# 导入sqlite3库(用于压缩Chroma的SQLite文件)
+import sqlite3
+# 导入subprocess库(用于在独立进程中压缩数据库)
+import subprocess
+# 导入sys库(用于获取当前Python解释器)
+import sys
+
+# Chroma 数据库目录（与 chroma.CHROMA_DB_PATH 一致）
+DEFAULT_DB_PATH = "./chroma_db"
+
+# 独立进程压缩的超时时间（秒）
+COMPACT_TIMEOUT = 600
+
+
+def compact_storage(db_path=DEFAULT_DB_PATH, out_of_process=False):
+    """压缩 Chroma 的 SQLite 文件（VACUUM 并截断 WAL）
+
+    VACUUM 需要数据库的独占锁：其他连接（包括应用中打开的 PersistentClient）
+    必须处于空闲状态，即没有上传/删除正在进行；否则最多等待 30 秒后失败
+    （database is locked），数据不受影响。VACUUM 不改变数据内容，已打开的客户端
+    无需重新连接。应用内调用时使用 out_of_process=True，在独立进程中执行，
+    不与本进程的 Chroma 连接共用 SQLite 状态。
+
+    HNSW 索引文件中被删除的位置会在后续写入时复用，这里不重写索引文件。
+
+    Args:
+        db_path: Chroma 数据库目录
+        out_of_process: 是否通过 `python compaction.py` 在独立进程中执行
+
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    if out_of_process:
+        try:
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--db-path", db_path],
+                capture_output=True,
+                text=True,
+                timeout=COMPACT_TIMEOUT
+            )
+        except Exception as e:
+            return False, f"压缩失败: {str(e)}"
+        output = (completed.stdout or completed.stderr).strip().splitlines()
+        return completed.returncode == 0, output[-1] if output else "压缩失败"
+
+    sqlite_path = os.path.join(db_path, "chroma.sqlite3")
+    if not os.path.exists(sqlite_path):
+        return False, f"未找到数据库文件: {sqlite_path}"
+
+    try:
+        connection = sqlite3.connect(sqlite_path, timeout=30)
+        try:
+            connection.execute("VACUUM")
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            connection.close()
+        return True, "压缩完成"
+    except Exception as e:
+        return False, f"压缩失败: {str(e)}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压缩 Chroma 数据库（需要没有上传/删除正在进行）")
+    parser.add_argument("--db-path", default=DEFAULT_DB_PATH, help="Chroma 数据库目录")
+    args = parser.parse_args()
+
+    success, message = compact_storage(args.db_path)
+    print(message)
+    sys.exit(0 if success else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,552 @@
+# 文档加载器注册表
+# 按 "扩展名 + 文件头魔数" 识别文件类型，每种类型优先使用最快的原生解析器，
+# 较重的 unstructured 加载器只作为兜底。每个加载器都有超时时间，
+# 默认在一个可复用的 spawn 子进程中运行，避免异常文件卡死或拖垮主进程。
+# 本模块不依赖 streamlit，也不导入嵌入模型；子进程只在首次使用或超时重建时
+# 付出一次启动开销，解析耗时在子进程内统计，不含启动时间。
+
+# 导入multiprocessing库(用于隔离运行加载器)
+import multiprocessing
+# 导入os库(用于处理文件路径和大小)
+import os
+# 导入threading库(用于保护统计数据)
+import threading
+# 导入time库(用于计时)
+import time
+# 导入zipfile库(用于识别docx/xlsx等Office文件)
+import zipfile
+
+# 从LangChain库中导入Document(统一的文档对象)
+from langchain_core.documents import Document
+
+## 文件类型识别
+
+# 扩展名到内部类型的映射
+EXTENSION_TYPES = {
+    ".txt": "txt",
+    ".text": "txt",
+    ".md": "md",
+    ".markdown": "md",
+    ".pdf": "pdf",
+    ".docx": "docx",
+    ".xlsx": "xlsx",
+    ".xls": "xls",
+}
+
+# 浏览器上报的 MIME 类型到内部类型的映射
+MIME_TYPES = {
+    "text/plain": "txt",
+    "text/markdown": "md",
+    "text/x-markdown": "md",
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+    "application/vnd.ms-excel": "xls",
+}
+
+# 读取文件头的字节数
+SNIFF_BYTES = 4096
+
+
+def normalize_file_type(file_type):
+    """将扩展名、MIME 类型或简写统一为内部类型（如 'pdf'），无法识别时返回 None"""
+    if not file_type:
+        return None
+    value = str(file_type).strip().lower()
+    if value in MIME_TYPES:
+        return MIME_TYPES[value]
+    if not value.startswith("."):
+        value = "." + value
+    return EXTENSION_TYPES.get(value)
+
+
+def sniff_file_type(file_path):
+    """根据文件头魔数判断文件格式
+
+    Returns:
+        str: 'pdf'、'docx'、'xlsx'、'zip'、'ole'、'text'，无法判断时返回 None
+    """
+    try:
+        with open(file_path, "rb") as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError:
+        return None
+
+    if head.startswith(b"%PDF-"):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        # Office Open XML 文件本质是 zip 包，通过内部目录区分
+        try:
+            with zipfile.ZipFile(file_path) as zf:
+                names = set(zf.namelist())
+        except zipfile.BadZipFile:
+            return None
+        if "word/document.xml" in names:
+            return "docx"
+        if "xl/workbook.xml" in names:
+            return "xlsx"
+        return "zip"
+    if head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):
+        # 旧版 Office 复合文档（xls/doc）
+        return "ole"
+    if b"\x00" not in head:
+        return "text"
+    return None
+
+
+def detect_file_type(file_path, file_type_hint=None):
+    """结合扩展名、调用方提供的类型提示和文件头魔数识别文件类型
+
+    Args:
+        file_path: 文件路径
+        file_type_hint: 类型提示，可以是扩展名或 MIME 类型（如 file.type）
+
+    Returns:
+        str: 内部类型（txt/md/pdf/docx/xlsx/xls），无法识别时返回 None
+    """
+    declared = normalize_file_type(os.path.splitext(file_path)[1]) or normalize_file_type(file_type_hint)
+    magic = sniff_file_type(file_path)
+
+    # 文件内容能明确判断格式时，以内容为准
+    if magic in ("pdf", "docx", "xlsx"):
+        return magic
+    if magic == "ole":
+        return "xls"
+    if magic == "text":
+        return declared if declared in ("txt", "md") else "txt"
+    if magic == "zip":
+        # 主文档部件名不标准的 Office 文件也是普通 zip 包，按声明的类型交给加载器判断
+        return declared if declared in ("docx", "xlsx") else None
+    return declared
+
+## 原生解析器（快速路径）
+
+# 字节顺序标记（BOM）-> 编码；UTF-32 LE 的 BOM 以 UTF-16 LE 的 BOM 开头，需先判断
+TEXT_BOMS = [
+    (b"\xff\xfe\x00\x00", "utf-32-le"),
+    (b"\x00\x00\xfe\xff", "utf-32-be"),
+    (b"\xef\xbb\xbf", "utf-8-sig"),
+    (b"\xff\xfe", "utf-16-le"),
+    (b"\xfe\xff", "utf-16-be"),
+]
+
+# gb18030 解码结果中"正常"字符的最低占比
+GB18030_MIN_PLAUSIBLE_RATIO = 0.95
+# 非 ASCII 字符中属于 GB2312 常用字符集的最低占比（真实中文文本几乎都是常用字，
+# 而 latin-1 等编码被误解码时大多落在常用字区以外）
+GB2312_MIN_COMMON_RATIO = 0.9
+
+
+def _is_plausible_chinese_text(text):
+    """粗略判断 gb18030 解码结果是否为正常文本
+
+    gb18030 几乎能解码任意字节序列，因此需要检查结果：不能有控制字符，
+    绝大多数字符应为 ASCII、汉字或中文标点，且非 ASCII 字符大多属于 GB2312 常用字符集。
+    """
+    if not text:
+        return True
+    plausible = 0
+    non_ascii = 0
+    common = 0
+    for char in text:
+        if ord(char) >= 0x80:
+            non_ascii += 1
+            try:
+                char.encode("gb2312")
+                common += 1
+            except UnicodeEncodeError:
+                pass
+        code = ord(char)
+        if char in "\t\n\r\f":
+            plausible += 1
+        elif code < 0x20 or code == 0x7f or char == "\ufffd":
+            return False
+        elif (code < 0x80
+              or 0x4e00 <= code <= 0x9fff      # 常用汉字
+              or 0x3400 <= code <= 0x4dbf      # 扩展A
+              or 0x3000 <= code <= 0x303f      # 中文标点
+              or 0xff00 <= code <= 0xffef      # 全角字符
+              or 0x2000 <= code <= 0x206f):    # 通用标点
+            plausible += 1
+    if plausible / len(text) < GB18030_MIN_PLAUSIBLE_RATIO:
+        return False
+    return non_ascii == 0 or common / non_ascii >= GB2312_MIN_COMMON_RATIO
+
+
+def _read_text(file_path):
+    """读取文本文件
+
+    有 BOM 时按 BOM 解码；否则依次尝试 utf-8 与 gb18030（需通过合理性检查）。
+    都不行时抛出异常，由兜底加载器（自动识别编码）处理。
+    """
+    with open(file_path, "rb") as f:
+        raw = f.read()
+    for bom, encoding in TEXT_BOMS:
+        if raw.startswith(bom):
+            text = raw.decode(encoding)
+            return text.lstrip("\ufeff")
+    if b"\x00" in raw:
+        # 含 NUL 字节：无 BOM 的 UTF-16/32 或二进制文件
+        raise ValueError("无法识别文本编码（含 NUL 字节，可能是无 BOM 的 UTF-16/32）")
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    try:
+        text = raw.decode("gb18030")
+    except UnicodeDecodeError:
+        text = None
+    if text is not None and _is_plausible_chinese_text(text):
+        return text
+    raise ValueError("无法识别文本编码（非 UTF-8/GB18030）")
+
+
+def load_text_native(file_path):
+    """直接读取文本/Markdown 文件"""
+    return [Document(page_content=_read_text(file_path), metadata={"source": file_path})]
+
+
+def load_pdf_pypdf(file_path):
+    """使用 pypdf 直接按页提取文本"""
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    documents = []
+    for page_number, page in enumerate(reader.pages):
+        text = page.extract_text() or ""
+        if text.strip():
+            documents.append(Document(
+                page_content=text,
+                metadata={"source": file_path, "page": page_number}
+            ))
+    return documents
+
+
+def load_docx_docx2txt(file_path):
+    """使用 docx2txt 直接提取 Word 文本"""
+    import docx2txt
+
+    text = docx2txt.process(file_path) or ""
+    return [Document(page_content=text, metadata={"source": file_path})]
+
+
+def _load_excel_pandas(file_path, engine):
+    """使用 pandas 将每个工作表转换为一个文档"""
+    import pandas as pd
+
+    excel_file = pd.ExcelFile(file_path, engine=engine)
+    documents = []
+    for sheet_name in excel_file.sheet_names:
+        df = excel_file.parse(sheet_name)
+
+        # 将DataFrame转换为文本
+        text_content = f"工作表: {sheet_name}\n\n"
+        if not df.empty:
+            # 添加列名
+            text_content += "列名: " + ", ".join(df.columns.astype(str)) + "\n\n"
+
+            # 添加数据行
+            for index, row in df.iterrows():
+                row_text = " | ".join([f"{col}: {val}" for col, val in row.items() if pd.notna(val)])
+                if row_text.strip():
+                    text_content += f"行{index + 1}: {row_text}\n"
+
+        documents.append(Document(
+            page_content=text_content,
+            metadata={"source": file_path, "sheet_name": sheet_name}
+        ))
+    return documents
+
+
+def load_xlsx_pandas(file_path):
+    """使用 pandas + openpyxl 读取 xlsx"""
+    return _load_excel_pandas(file_path, "openpyxl")
+
+
+def load_xls_pandas(file_path):
+    """使用 pandas + xlrd 读取 xls"""
+    return _load_excel_pandas(file_path, "xlrd")
+
+## LangChain / unstructured 加载器（兜底）
+
+def load_text_langchain(file_path):
+    from langchain_community.document_loaders import TextLoader
+    return TextLoader(file_path, autodetect_encoding=True).load()
+
+
+def load_pdf_langchain(file_path):
+    from langchain_community.document_loaders import PyPDFLoader
+    return PyPDFLoader(file_path).load()
+
+
+def load_pdf_unstructured(file_path):
+    from langchain_community.document_loaders import UnstructuredPDFLoader
+    return UnstructuredPDFLoader(file_path).load()
+
+
+def load_docx_unstructured(file_path):
+    from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+    return UnstructuredWordDocumentLoader(file_path).load()
+
+
+def load_markdown_unstructured(file_path):
+    from langchain_community.document_loaders import UnstructuredMarkdownLoader
+    return UnstructuredMarkdownLoader(file_path).load()
+
+
+def load_excel_unstructured(file_path):
+    from langchain_community.document_loaders import UnstructuredExcelLoader
+    return UnstructuredExcelLoader(file_path).load()
+
+## 加载器注册表
+
+# 默认超时时间（秒）
+DEFAULT_LOADER_TIMEOUT = 60
+
+# 文件类型 -> 按优先级排列的加载器列表
+LOADER_REGISTRY = {}
+
+
+def register_loader(file_type, name, func, timeout=DEFAULT_LOADER_TIMEOUT, fallback=False):
+    """注册一个加载器
+
+    Args:
+        file_type: 内部类型（如 'pdf'）
+        name: 加载器名称（用于统计和日志）
+        func: 加载函数，接收文件路径，返回 Document 列表；
+              隔离运行时需为可导入的模块级函数，以便传入 spawn 子进程
+        timeout: 超时时间（秒）
+        fallback: 是否为兜底加载器（排在所有快速加载器之后）
+    """
+    loaders = LOADER_REGISTRY.setdefault(file_type, [])
+    loaders.append({
+        "name": name,
+        "func": func,
+        "timeout": timeout,
+        "fallback": fallback,
+    })
+    # 快速加载器优先，同类保持注册顺序
+    loaders.sort(key=lambda loader: loader["fallback"])
+
+
+register_loader("txt", "native-text", load_text_native, timeout=30)
+register_loader("txt", "langchain-text", load_text_langchain, timeout=30, fallback=True)
+register_loader("md", "native-text", load_text_native, timeout=30)
+register_loader("md", "unstructured-markdown", load_markdown_unstructured, timeout=120, fallback=True)
+register_loader("pdf", "pypdf", load_pdf_pypdf, timeout=120)
+register_loader("pdf", "langchain-pypdf", load_pdf_langchain, timeout=120, fallback=True)
+register_loader("pdf", "unstructured-pdf", load_pdf_unstructured, timeout=300, fallback=True)
+register_loader("docx", "docx2txt", load_docx_docx2txt, timeout=60)
+register_loader("docx", "unstructured-docx", load_docx_unstructured, timeout=180, fallback=True)
+register_loader("xlsx", "pandas-openpyxl", load_xlsx_pandas, timeout=120)
+register_loader("xlsx", "unstructured-excel", load_excel_unstructured, timeout=300, fallback=True)
+register_loader("xls", "pandas-xlrd", load_xls_pandas, timeout=120)
+register_loader("xls", "unstructured-excel", load_excel_unstructured, timeout=300, fallback=True)
+
+## 解析统计
+
+_LOADER_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+
+def _record_stats(name, outcome, file_size, seconds, documents=None):
+    """记录一次加载器调用（outcome: ok / error / timeout）"""
+    with _STATS_LOCK:
+        stats = _LOADER_STATS.setdefault(name, {
+            "calls": 0,
+            "successes": 0,
+            "failures": 0,
+            "timeouts": 0,
+            "bytes": 0,
+            "chars": 0,
+            "ok_seconds": 0.0,
+            "failed_seconds": 0.0,
+        })
+        stats["calls"] += 1
+        if outcome == "ok":
+            stats["successes"] += 1
+            stats["ok_seconds"] += seconds
+            stats["bytes"] += file_size
+            stats["chars"] += sum(len(doc.page_content) for doc in documents or [])
+        elif outcome == "timeout":
+            stats["timeouts"] += 1
+            stats["failed_seconds"] += seconds
+        else:
+            stats["failures"] += 1
+            stats["failed_seconds"] += seconds
+
+
+def get_loader_statistics():
+    """获取每个加载器的解析统计
+
+    Returns:
+        dict: 加载器名称 -> 调用次数、成功/失败/超时次数、成功与失败（含超时）的累计耗时、
+              吞吐量（MB/s，仅按成功调用的字节数和耗时计算）
+    """
+    with _STATS_LOCK:
+        snapshot = {name: dict(stats) for name, stats in _LOADER_STATS.items()}
+    for stats in snapshot.values():
+        seconds = stats["ok_seconds"]
+        stats["mb_per_second"] = stats["bytes"] / 1024 / 1024 / seconds if seconds > 0 else 0.0
+    return snapshot
+
+
+## 加载执行
+
+# 解析子进程启动（导入本模块）的超时时间（秒）
+WORKER_START_TIMEOUT = 60
+
+
+def _loader_worker(conn):
+    """子进程入口：循环接收加载任务，在子进程内计时并把结果发回"""
+    conn.send(("ready", None, 0.0))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        func, file_path = task
+        start = time.perf_counter()
+        try:
+            documents = func(file_path)
+            conn.send(("ok", documents, time.perf_counter() - start))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}", time.perf_counter() - start))
+    conn.close()
+
+
+class LoaderWorker:
+    """可复用的解析子进程
+
+    使用 spawn 启动，子进程不继承主进程（Streamlit）的线程和已加载的 torch/分词器，
+    只导入本模块。子进程在多次加载之间复用，只有超时或崩溃时才终止并在下次调用时重建。
+    同一时间只处理一个任务，并发调用会排队。
+    """
+
+    def __init__(self, start_timeout=WORKER_START_TIMEOUT):
+        self.start_timeout = start_timeout
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+
+    def _start(self):
+        """启动子进程并等待其就绪"""
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=_loader_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        self._process, self._conn = process, parent_conn
+        if not parent_conn.poll(self.start_timeout):
+            self._stop()
+            raise RuntimeError(f"解析进程启动超时（{self.start_timeout} 秒）")
+        try:
+            parent_conn.recv()
+        except EOFError:
+            process.join(1)
+            exitcode = process.exitcode
+            self._stop()
+            raise RuntimeError(f"解析进程启动失败 (exitcode={exitcode})")
+
+    def _stop(self):
+        """终止子进程"""
+        if self._conn is not None:
+            self._conn.close()
+        if self._process is not None and self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._process, self._conn = None, None
+
+    def run(self, func, file_path, timeout):
+        """在子进程中运行加载器
+
+        Args:
+            func: 加载函数（需为模块级函数，以便传入子进程）
+            file_path: 文件路径
+            timeout: 超时时间（秒），不含子进程启动时间
+
+        Returns:
+            tuple: (status, payload, seconds)
+                status 为 'ok' / 'error' / 'timeout'；payload 为文档列表或错误信息；
+                seconds 为子进程内的解析耗时（超时时为 timeout）
+        """
+        with self._lock:
+            try:
+                if self._process is None or not self._process.is_alive():
+                    self._start()
+                self._conn.send((func, file_path))
+            except Exception as e:
+                return "error", f"{type(e).__name__}: {e}", 0.0
+
+            start = time.perf_counter()
+            if not self._conn.poll(timeout):
+                # 超时的子进程可能卡在解析中，直接终止，下次调用时重建
+                self._stop()
+                return "timeout", f"解析超时（{timeout} 秒）", timeout
+            try:
+                return self._conn.recv()
+            except EOFError:
+                self._process.join(1)
+                exitcode = self._process.exitcode
+                self._stop()
+                return "error", f"解析进程异常退出 (exitcode={exitcode})", time.perf_counter() - start
+
+
+# 共享的解析子进程
+_LOADER_WORKER = LoaderWorker()
+
+
+def _run_loader_inline(func, file_path):
+    """在当前进程中运行加载器，返回格式同 LoaderWorker.run（不强制超时）"""
+    start = time.perf_counter()
+    try:
+        return "ok", func(file_path), time.perf_counter() - start
+    except Exception as e:
+        return "error", f"{type(e).__name__}: {e}", time.perf_counter() - start
+
+
+def load_with_registry(file_path, file_type_hint=None, isolate=True):
+    """按注册表依次尝试加载器，返回第一个成功的结果
+
+    Args:
+        file_path: 文件路径
+        file_type_hint: 类型提示（扩展名或 MIME 类型）
+        isolate: 是否在子进程中运行加载器（只有隔离运行时超时才会强制生效）
+
+    Returns:
+        tuple: (documents: list | None, loader_name: str | None, errors: list[str])
+    """
+    file_type = detect_file_type(file_path, file_type_hint)
+    if file_type is None or file_type not in LOADER_REGISTRY:
+        return None, None, [f"不支持的文件类型: {file_type_hint or os.path.splitext(file_path)[1]}"]
+
+    try:
+        file_size = os.path.getsize(file_path)
+    except OSError:
+        file_size = 0
+
+    errors = []
+    for loader in LOADER_REGISTRY[file_type]:
+        if isolate:
+            status, payload, seconds = _LOADER_WORKER.run(loader["func"], file_path, loader["timeout"])
+        else:
+            status, payload, seconds = _run_loader_inline(loader["func"], file_path)
+
+        if status != "ok":
+            _record_stats(loader["name"], status, file_size, seconds)
+            errors.append(f"{loader['name']}: {payload}")
+            continue
+
+        documents = payload
+        # 没有提取到任何文本时记为失败，继续尝试下一个加载器
+        if not documents or not any(doc.page_content.strip() for doc in documents):
+            _record_stats(loader["name"], "error", file_size, seconds)
+            errors.append(f"{loader['name']}: 未提取到文本")
+            continue
+
+        _record_stats(loader["name"], "ok", file_size, seconds, documents)
+        return documents, loader["name"], errors
+
+    return None, None, errors
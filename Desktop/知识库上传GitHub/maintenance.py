@@ -0,0 +1,314 @@
+# 存储整理工具
+# 对比 "知识库文件" 目录与向量数据库，找出并修复不一致的数据，
+# 然后压缩 Chroma 底层的 SQLite 文件，报告回收的空间和耗时。
+#
+# 命令行用法:
+#     python maintenance.py             # 检查并修复
+#     python maintenance.py --dry-run   # 只检查，不修改
+#     python maintenance.py --reindex   # 同时为未入库和块不完整的文件重新生成向量
+#     python maintenance.py --compact-only   # 只压缩数据库
+#
+# 压缩（VACUUM）需要数据库的独占锁，请在没有上传/删除进行时运行。
+# 压缩代码位于只依赖标准库的 compaction.py；只需压缩时直接运行 python compaction.py，
+# 不会加载 Chroma 和嵌入模型（应用内的独立进程压缩也是如此）。
+
+# 导入argparse库(用于解析命令行参数)
+import argparse
+# 导入os库(用于操作文件和目录)
+import os
+# 导入sys库(用于设置命令行退出码)
+import sys
+# 导入time库(用于计时)
+import time
+
+# 导入知识库核心函数
+import chroma
+# 导入数据库压缩工具（只依赖标准库）
+from compaction import compact_storage
+# 导入只读副本的变更日志工具
+import replica
+
+# 知识库文件保存目录（与 app.py 一致）
+DEFAULT_SAVE_DIR = "知识库文件"
+
+## 1. 检查
+
+def _iter_metadatas(collection, page_size=1000):
+    """分页遍历集合中所有记录的ID和元数据（不读取文本和向量）"""
+    offset = 0
+    while True:
+        results = collection.get(include=['metadatas'], limit=page_size, offset=offset)
+        if not results['ids']:
+            return
+        for record_id, metadata in zip(results['ids'], results['metadatas']):
+            yield record_id, metadata or {}
+        if len(results['ids']) < page_size:
+            return
+        offset += len(results['ids'])
+
+
+def scan_storage(collection, save_dir=DEFAULT_SAVE_DIR, page_size=1000):
+    """检查文件目录与向量数据库之间的不一致
+
+    Args:
+        collection: Chroma集合对象
+        save_dir: 知识库文件目录
+        page_size: 每次读取的记录数
+
+    Returns:
+        dict: 检查结果
+            orphaned_ids: 对应文件已不存在的向量记录ID
+            orphaned_files: 上述记录涉及的文件名
+            unindexed_files: 目录中存在但没有任何向量记录的文件
+            duplicate_ids: 重复上传产生的多余记录ID
+            duplicate_files: 存在重复记录的文件名
+            stale_updates: 需要修正 total_chunks 的记录 {id: 新元数据}
+            stale_files: total_chunks 过期的文件 {文件名: (原值, 实际块数)}
+            incomplete_files: 块索引有缺口、需要重新入库的文件 {文件名: 缺失的块索引}
+    
+    Raises:
+        FileNotFoundError: save_dir 不存在（不能当作空目录处理，否则所有向量都会被判为孤立）
+    """
+    if not os.path.isdir(save_dir):
+        raise FileNotFoundError(f"知识库文件目录不存在: {save_dir}")
+    
+    files_on_disk = set()
+    for file_name in os.listdir(save_dir):
+        if os.path.isfile(os.path.join(save_dir, file_name)):
+            files_on_disk.add(file_name)
+
+    # 按文件分组
+    records_by_file = {}
+    for record_id, metadata in _iter_metadatas(collection, page_size):
+        records_by_file.setdefault(metadata.get('file_name'), []).append((record_id, metadata))
+
+    issues = {
+        "orphaned_ids": [],
+        "orphaned_files": [],
+        "unindexed_files": sorted(files_on_disk - set(records_by_file)),
+        "duplicate_ids": [],
+        "duplicate_files": [],
+        "stale_updates": {},
+        "stale_files": {},
+        "incomplete_files": {},
+    }
+
+    for file_name, records in records_by_file.items():
+        # 1. 文件已删除，向量仍在
+        if file_name not in files_on_disk:
+            issues["orphaned_ids"].extend(record_id for record_id, _ in records)
+            issues["orphaned_files"].append(file_name if file_name is not None else "未知文件")
+            continue
+
+        # 2. 按上传批次分组；旧数据没有 upload_id，按 total_chunks 近似区分
+        upload_sets = {}
+        for record_id, metadata in records:
+            set_key = metadata.get('upload_id') or f"legacy:{metadata.get('total_chunks')}"
+            upload_sets.setdefault(set_key, []).append((record_id, metadata))
+
+        # 保留最新的一次上传（旧数据则保留块数最多的一组）
+        keep_key = max(upload_sets, key=lambda key: (
+            upload_sets[key][0][1].get('upload_time', ''),
+            len(upload_sets[key])
+        ))
+        duplicate_ids = []
+        for set_key, set_records in upload_sets.items():
+            if set_key != keep_key:
+                duplicate_ids.extend(record_id for record_id, _ in set_records)
+
+        # 同一批次内同一块索引只保留一条
+        kept_records = []
+        seen_indexes = set()
+        for record_id, metadata in upload_sets[keep_key]:
+            chunk_index = metadata.get('chunk_index')
+            if chunk_index in seen_indexes:
+                duplicate_ids.append(record_id)
+            else:
+                seen_indexes.add(chunk_index)
+                kept_records.append((record_id, metadata))
+
+        if duplicate_ids:
+            issues["duplicate_ids"].extend(duplicate_ids)
+            issues["duplicate_files"].append(file_name)
+
+        # 3. 块索引有缺口（写入中途失败等）时无法只靠改元数据修复，标记为需要重新入库
+        indexes = [index for index in seen_indexes if isinstance(index, int)]
+        actual_chunks = max(indexes) + 1 if indexes else len(kept_records)
+        missing_indexes = sorted(set(range(actual_chunks)) - set(indexes))
+        if missing_indexes:
+            issues["incomplete_files"][file_name] = missing_indexes
+            continue
+
+        # 4. total_chunks 与实际块数不符
+        recorded_chunks = kept_records[0][1].get('total_chunks')
+        if any(metadata.get('total_chunks') != actual_chunks for _, metadata in kept_records):
+            issues["stale_files"][file_name] = (recorded_chunks, actual_chunks)
+            for record_id, metadata in kept_records:
+                if metadata.get('total_chunks') != actual_chunks:
+                    issues["stale_updates"][record_id] = dict(metadata, total_chunks=actual_chunks)
+
+    return issues
+
+## 2. 修复
+
+def repair_storage(collection, issues, save_dir=DEFAULT_SAVE_DIR, model=None, batch_size=500):
+    """按批次修复 scan_storage 找到的问题
+
+    Args:
+        collection: Chroma集合对象
+        issues: scan_storage 的返回结果
+        save_dir: 知识库文件目录
+        model: 嵌入模型；提供时为未入库和块不完整的文件重新生成向量，否则跳过这些文件
+        batch_size: 每批删除/更新的记录数
+
+    Returns:
+        dict: 修复结果（删除的孤立/重复记录数、修正的记录数、重新入库的文件及失败信息）
+    """
+    result = {
+        "deleted_orphaned": 0,
+        "deleted_duplicates": 0,
+        "updated_total_chunks": 0,
+        "reindexed_files": [],
+        "errors": [],
+    }
+
+    result["deleted_orphaned"] = chroma.delete_ids_in_batches(issues["orphaned_ids"], collection, batch_size)
+    result["deleted_duplicates"] = chroma.delete_ids_in_batches(issues["duplicate_ids"], collection, batch_size)
+
+    stale_ids = list(issues["stale_updates"])
+    for start in range(0, len(stale_ids), batch_size):
+        batch_ids = stale_ids[start:start + batch_size]
+        collection.update(
+            ids=batch_ids,
+            metadatas=[issues["stale_updates"][record_id] for record_id in batch_ids]
+        )
+        chroma.record_change("upsert", batch_ids)
+    result["updated_total_chunks"] = len(stale_ids)
+
+    if model is not None:
+        for file_name in issues["unindexed_files"] + sorted(issues["incomplete_files"]):
+            file_path = os.path.join(save_dir, file_name)
+            success, message = chroma.index_file(file_path, file_name, None, collection, model)
+            if success:
+                result["reindexed_files"].append(file_name)
+            else:
+                result["errors"].append(f"{file_name}: {message}")
+
+    return result
+
+## 3. 压缩
+
+def get_directory_size(path):
+    """统计目录占用的字节数"""
+    total_size = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            if os.path.exists(file_path):
+                total_size += os.path.getsize(file_path)
+    return total_size
+
+## 4. 完整流程
+
+def run_maintenance(collection, save_dir=DEFAULT_SAVE_DIR, model=None, db_path=chroma.CHROMA_DB_PATH,
+                    dry_run=False, compact=True, compact_out_of_process=False):
+    """检查、修复并压缩存储
+
+    Args:
+        collection: Chroma集合对象
+        save_dir: 知识库文件目录
+        model: 嵌入模型（可选，用于为未入库和块不完整的文件重新生成向量）
+        db_path: Chroma 数据库目录
+        dry_run: 只检查，不修改
+        compact: 修复后是否压缩数据库
+        compact_out_of_process: 是否在独立进程中压缩（见 compact_storage）
+
+    Returns:
+        dict: 检查结果、修复结果、压缩结果、回收的字节数和各阶段耗时
+    """
+    report = {"dry_run": dry_run}
+    start_time = time.perf_counter()
+    size_before = get_directory_size(db_path)
+
+    issues = scan_storage(collection, save_dir)
+    report["issues"] = issues
+    report["scan_seconds"] = time.perf_counter() - start_time
+
+    if not dry_run:
+        repair_start = time.perf_counter()
+        report["repair"] = repair_storage(collection, issues, save_dir, model)
+        report["repair_seconds"] = time.perf_counter() - repair_start
+
+    if not dry_run and compact:
+        compact_start = time.perf_counter()
+        report["compact"] = compact_storage(db_path, out_of_process=compact_out_of_process)
+        # 只读副本发现日志被替换后会重新全量加载，日志不会无限增长
+        replica.truncate_change_log(db_path)
+        report["compact_seconds"] = time.perf_counter() - compact_start
+
+    size_after = get_directory_size(db_path)
+    report["size_before"] = size_before
+    report["size_after"] = size_after
+    report["reclaimed_bytes"] = max(0, size_before - size_after)
+    report["total_seconds"] = time.perf_counter() - start_time
+    return report
+
+
+def format_report(report):
+    """将 run_maintenance 的结果整理为可读的文本行"""
+    issues = report["issues"]
+    lines = [
+        f"孤立向量: {len(issues['orphaned_ids'])} 条（{len(issues['orphaned_files'])} 个文件）",
+        f"未入库文件: {len(issues['unindexed_files'])} 个",
+        f"重复记录: {len(issues['duplicate_ids'])} 条（{len(issues['duplicate_files'])} 个文件）",
+        f"块数过期: {len(issues['stale_updates'])} 条（{len(issues['stale_files'])} 个文件）",
+        f"块不完整: {len(issues['incomplete_files'])} 个文件（需重新入库）",
+    ]
+    if "repair" in report:
+        repair = report["repair"]
+        lines.append(
+            f"已删除孤立 {repair['deleted_orphaned']} 条、重复 {repair['deleted_duplicates']} 条，"
+            f"修正块数 {repair['updated_total_chunks']} 条，重新入库 {len(repair['reindexed_files'])} 个文件"
+        )
+        lines.extend(f"修复失败 {error}" for error in repair["errors"])
+    if "compact" in report:
+        lines.append(report["compact"][1])
+    lines.append(
+        f"数据库大小: {report['size_before']/1024/1024:.2f} MB → {report['size_after']/1024/1024:.2f} MB，"
+        f"回收 {report['reclaimed_bytes']/1024/1024:.2f} MB，耗时 {report['total_seconds']:.2f} 秒"
+    )
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查并修复知识库文件与向量数据库的一致性，然后压缩数据库")
+    parser.add_argument("--save-dir", default=DEFAULT_SAVE_DIR, help="知识库文件目录")
+    parser.add_argument("--dry-run", action="store_true", help="只检查，不修改")
+    parser.add_argument("--reindex", action="store_true", help="为未入库和块不完整的文件重新生成向量")
+    parser.add_argument("--no-compact", action="store_true", help="修复后不压缩数据库")
+    parser.add_argument("--compact-only", action="store_true", help="只压缩数据库（需要没有上传/删除正在进行）")
+    parser.add_argument("--db-path", default=chroma.CHROMA_DB_PATH, help="Chroma 数据库目录（仅用于 --compact-only）")
+    args = parser.parse_args()
+
+    if args.compact_only:
+        success, message = compact_storage(args.db_path)
+        print(message)
+        sys.exit(0 if success else 1)
+
+    if not os.path.isdir(args.save_dir):
+        parser.exit(1, f"知识库文件目录不存在: {args.save_dir}\n")
+
+    collection = chroma.init_chroma_db()
+    model = chroma.init_embedding_model() if args.reindex and not args.dry_run else None
+
+    try:
+        report = run_maintenance(collection, args.save_dir, model=model,
+                                 dry_run=args.dry_run, compact=not args.no_compact)
+    except FileNotFoundError as e:
+        parser.exit(1, f"{e}\n")
+    for line in format_report(report):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
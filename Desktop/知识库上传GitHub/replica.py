@@ -0,0 +1,294 @@
+# 内存只读副本
+# 查询由内存中的 Chroma 集合提供，不再与上传共用磁盘上的持久化集合。
+# 副本启动时从持久化集合全量加载，之后根据写入路径追加的变更日志增量同步；
+# 查询前若距上次同步超过允许的延迟（max_staleness 秒），会先同步再查询。
+# 日志超过 MAX_LOG_BYTES 时由写入方替换为空文件，副本发现后重新全量加载。
+#
+# 变更日志为 JSON Lines，每行记录一次写入涉及的ID（不含向量）:
+#     {"time": 1700000000.0, "op": "upsert", "ids": [...]}
+#     {"time": 1700000000.0, "op": "delete", "ids": [...]}
+
+# 导入json库(用于读写变更日志)
+import json
+# 导入os库(用于操作文件)
+import os
+# 导入threading库(用于保护副本状态)
+import threading
+# 导入time库(用于计时)
+import time
+# 导入uuid库(用于生成副本集合名称)
+import uuid
+
+# 导入Chroma向量数据库的主库
+import chromadb
+# 从Chroma库中导入配置设置
+from chromadb.config import Settings
+
+# 变更日志文件名（位于数据库目录下）
+CHANGE_LOG_NAME = "replica_changes.jsonl"
+
+# 变更日志超过该大小（字节）时轮换
+MAX_LOG_BYTES = 16 * 1024 * 1024
+
+# HNSW 图每条记录的大致开销（默认 M=16，底层双向链接，4 字节ID）
+HNSW_BYTES_PER_RECORD = 16 * 2 * 4
+
+## 变更日志
+
+def change_log_path(db_path):
+    """变更日志路径"""
+    return os.path.join(db_path, CHANGE_LOG_NAME)
+
+
+def append_change(db_path, op, ids):
+    """追加一条变更记录
+
+    Args:
+        db_path: 数据库目录
+        op: 'upsert' 或 'delete'
+        ids: 涉及的记录ID
+    """
+    ids = list(ids)
+    if not ids:
+        return
+    entry = {"time": time.time(), "op": op, "ids": ids}
+    line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+    path = change_log_path(db_path)
+    # 多个写入方（各会话、命令行工具）共用日志：整行用一次 os.write 追加到 O_APPEND 文件，
+    # 避免缓冲写入被拆成多次系统调用后与其他写入方的行交错
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+    # 日志过大时轮换；本次变更已写入持久化集合，副本重新全量加载时会包含它
+    if size > MAX_LOG_BYTES:
+        truncate_change_log(db_path)
+
+
+def truncate_change_log(db_path):
+    """清空变更日志
+
+    以替换文件的方式清空，正在读取的副本会发现文件已更换并重新全量加载。
+    """
+    path = change_log_path(db_path)
+    if not os.path.exists(path):
+        return
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    open(tmp_path, "w", encoding="utf-8").close()
+    os.replace(tmp_path, path)
+
+## 只读副本
+
+class ReadReplica:
+    """持久化集合的内存只读副本"""
+
+    def __init__(self, source, db_path, max_staleness=5.0, page_size=1000):
+        """
+        Args:
+            source: 持久化的 Chroma 集合对象
+            db_path: 数据库目录（变更日志所在位置）
+            max_staleness: 允许的最大延迟（秒），超过后查询前先同步
+            page_size: 加载和同步时每批读取的记录数
+        """
+        self.source = source
+        self.db_path = db_path
+        self.max_staleness = max_staleness
+        self.page_size = page_size
+        self.collection = None
+        # 上一次全量加载前的集合，推迟到下一次加载时再删除，避免正在使用它的查询失败
+        self._retired_collection = None
+
+        self._client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+        self._lock = threading.Lock()
+        # 变更日志读取位置：(文件 inode, 已读取的字节数)
+        self._log_inode = None
+        self._log_offset = 0
+        self._last_refresh = 0.0
+        self._malformed_lines = 0
+        # 变更日志写入失败时由写入方设置，下一次查询前重新全量加载
+        self._reload_requested = False
+        self._dimension = 0
+        # 记录ID -> 文本和元数据占用的字节数（用于估算内存）
+        self._record_bytes = {}
+
+        with self._lock:
+            self._load()
+
+    def _log_position(self):
+        """当前变更日志的 (inode, 大小)，不存在时返回 (None, 0)"""
+        try:
+            stat = os.stat(change_log_path(self.db_path))
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def _log_replaced(self):
+        """变更日志是否已被清空或替换（副本需要重新全量加载）"""
+        inode, size = self._log_position()
+        if self._log_inode is None and self._log_offset == 0:
+            # 加载时日志还不存在，之后新建的日志从头读取即可
+            self._log_inode = inode
+            return False
+        return inode != self._log_inode or size < self._log_offset
+
+    def _load(self):
+        """从持久化集合全量加载到新集合，完成后再替换当前集合"""
+        # 先记录日志位置，加载期间产生的变更会在下次同步时重放（upsert 可重复执行）
+        log_inode, log_offset = self._log_position()
+        self._reload_requested = False
+
+        # 删除更早一代的集合，此时已没有查询在使用它
+        if self._retired_collection is not None:
+            try:
+                self._client.delete_collection(self._retired_collection.name)
+            except Exception:
+                pass
+            self._retired_collection = None
+
+        collection = self._client.create_collection(
+            name=f"{self.source.name}_replica_{uuid.uuid4().hex[:8]}",
+            metadata=self.source.metadata
+        )
+        record_bytes = {}
+
+        offset = 0
+        while True:
+            page = self.source.get(
+                include=['documents', 'metadatas', 'embeddings'],
+                limit=self.page_size,
+                offset=offset
+            )
+            if not page['ids']:
+                break
+            self._upsert(page, collection, record_bytes)
+            if len(page['ids']) < self.page_size:
+                break
+            offset += len(page['ids'])
+
+        # 替换当前集合；旧集合保留到下一次加载，已拿到它的查询仍可正常完成
+        self._retired_collection = self.collection
+        self.collection = collection
+        self._record_bytes = record_bytes
+        self._log_inode, self._log_offset = log_inode, log_offset
+        self._last_refresh = time.time()
+
+    def _upsert(self, page, collection=None, record_bytes=None):
+        """将一页记录写入副本（默认写入当前集合）"""
+        if not page['ids']:
+            return
+        collection = collection if collection is not None else self.collection
+        record_bytes = record_bytes if record_bytes is not None else self._record_bytes
+        collection.upsert(
+            ids=page['ids'],
+            documents=page['documents'],
+            metadatas=page['metadatas'],
+            embeddings=page['embeddings']
+        )
+        if not self._dimension and len(page['embeddings']):
+            self._dimension = len(page['embeddings'][0])
+        for record_id, document, metadata in zip(page['ids'], page['documents'], page['metadatas']):
+            record_bytes[record_id] = (
+                len((document or "").encode("utf-8"))
+                + len(json.dumps(metadata or {}, ensure_ascii=False).encode("utf-8"))
+            )
+
+    def _read_pending(self):
+        """读取尚未同步的变更
+
+        Returns:
+            tuple: (变更列表, 读取的字节数, 无法解析的行数)
+        """
+        path = change_log_path(self.db_path)
+        try:
+            with open(path, "rb") as f:
+                f.seek(self._log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], 0, 0
+        # 只处理完整的行，写了一半的行留到下次
+        end = data.rfind(b"\n") + 1
+        entries = []
+        malformed = 0
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                if entry["op"] not in ("upsert", "delete") or not isinstance(entry["ids"], list):
+                    raise ValueError(entry["op"])
+                float(entry["time"])
+            except (ValueError, KeyError, TypeError):
+                malformed += 1
+                continue
+            entries.append(entry)
+        return entries, end, malformed
+
+    def _refresh(self):
+        """应用变更日志中尚未同步的记录"""
+        if self._reload_requested or self._log_replaced():
+            # 日志被清空或替换（或有变更未能写入日志），重新全量加载
+            self._load()
+            return
+
+        entries, consumed, malformed = self._read_pending()
+        if malformed:
+            # 无法确定损坏的行涉及哪些记录，重新全量加载（同时跳过这些行）
+            self._malformed_lines += malformed
+            self._load()
+            return
+
+        for entry in entries:
+            ids = entry["ids"]
+            for start in range(0, len(ids), self.page_size):
+                batch_ids = ids[start:start + self.page_size]
+                if entry["op"] == "delete":
+                    self.collection.delete(ids=batch_ids)
+                    for record_id in batch_ids:
+                        self._record_bytes.pop(record_id, None)
+                else:
+                    self._upsert(self.source.get(
+                        ids=batch_ids,
+                        include=['documents', 'metadatas', 'embeddings']
+                    ))
+        self._log_offset += consumed
+        self._last_refresh = time.time()
+
+    def request_reload(self):
+        """要求在下一次查询前重新全量加载（用于变更日志写入失败时）"""
+        self._reload_requested = True
+
+    def get_collection(self):
+        """返回用于查询的内存集合，超过允许延迟或被要求重新加载时先同步"""
+        with self._lock:
+            if self._reload_requested or time.time() - self._last_refresh > self.max_staleness:
+                self._refresh()
+            return self.collection
+
+    def status(self):
+        """副本状态
+
+        Returns:
+            dict: 记录数、待同步变更数、延迟（最早未同步变更至今的秒数）、
+                  距上次同步的秒数、估算的内存占用（字节）、累计跳过的损坏日志行数
+        """
+        with self._lock:
+            entries = [] if self._log_replaced() else self._read_pending()[0]
+            now = time.time()
+            lag = now - min(entry["time"] for entry in entries) if entries else 0.0
+            record_count = self.collection.count()
+            memory_bytes = (
+                record_count * (self._dimension * 4 + HNSW_BYTES_PER_RECORD)
+                + sum(self._record_bytes.values())
+            )
+            return {
+                "records": record_count,
+                "pending_changes": len(entries),
+                "lag_seconds": lag,
+                "since_refresh_seconds": now - self._last_refresh,
+                "memory_bytes": memory_bytes,
+                "malformed_lines": self._malformed_lines,
+            }